@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import json
 import time as t
 from pynvml import *
 import os
@@ -8,6 +10,9 @@ import sys
 import shutil
 import re
 import subprocess
+import signal
+import threading
+from dataclasses import dataclass
 import memtemp
 
 # Try to import sdnotify for systemd notifications, otherwise silently skip
@@ -17,27 +22,50 @@ except ImportError:
     SystemdNotifier = None
 
 # --- Functions for colored text display ---
-def get_color_text(color, text, bold=False):
-    color_dict = {
-        'red': '\033[91m',
-        'green': '\033[92m',
-        'yellow': '\033[93m',
-        'cyan': '\033[96m',
-        'blue': '\033[94m',
-        'white': '\033[97m',
-        'reset': '\033[0m'
-    }
-    bold_seq = '\033[1m' if bold else ''
-    return f'{bold_seq}{color_dict[color]}{text}{color_dict["reset"]}'
+COLORS = {
+    'red': '\033[91m',
+    'green': '\033[92m',
+    'yellow': '\033[93m',
+    'cyan': '\033[96m',
+    'blue': '\033[94m',
+    'white': '\033[97m',
+    'reset': '\033[0m'
+}
+BOLD = '\033[1m'
+
+@dataclass
+class Colored:
+    """A colored line, along with its visible length (without the ANSI escape codes)."""
+    text: str
+    vlen: int
+
+    def __str__(self):
+        return self.text
+
+def _mk(color):
+    """Returns a function that colors a text with the given color."""
+    esc = COLORS[color]
+    reset = COLORS['reset']
+    def colorize(text, bold=False):
+        text = str(text)
+        return Colored(f'{BOLD if bold else ""}{esc}{text}{reset}', len(text))
+    return colorize
+
+green = _mk('green')
+yellow = _mk('yellow')
+cyan = _mk('cyan')
+blue = _mk('blue')
 
 # To calculate the visible length of a string (by removing ANSI escape codes)
 ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
 def visible_length(text):
+    if isinstance(text, Colored):
+        return text.vlen
     return len(ansi_escape.sub('', text))
 
 def pad_text(text, width):
     """Pads the string with spaces to reach a visible width of 'width'."""
-    return text + ' ' * (width - visible_length(text))
+    return str(text) + ' ' * (width - visible_length(text))
 
 # --- Fonctions d'affichage en colonnes ---
 def print_columns(blocks, padding=4):
@@ -52,7 +80,7 @@ def print_columns(blocks, padding=4):
     # Calculate the maximum visible width of each block
     col_width = max(visible_length(line) for block in blocks for line in block)
 
-    term_width = shutil.get_terminal_size((80, 20)).columns
+    term_width = _term_size.columns
     # Number of columns that can fit in the terminal
     cols = max(1, term_width // (col_width + padding))
 
@@ -67,26 +95,81 @@ def print_columns(blocks, padding=4):
             if len(block) < max_lines:
                 block.extend([""] * (max_lines - len(block)))
         # Assemble each line of the row by adding a fixed spacing
+        row_width = len(row) * col_width + (len(row) - 1) * padding
         for i in range(max_lines):
             line_parts = [pad_text(block[i], col_width) for block in row]
-            output_lines.append((" " * padding).join(line_parts))
+            output_lines.append(Colored((" " * padding).join(line_parts), row_width))
     return output_lines
 
 def get_separator(char='=', length=40):
     return char * length
 
-def move_cursor_up(lines=1):
-    print(f'\033[{lines}F', end='')
+def write_stdout(text):
+    """
+    Writes the text to stdout as UTF-8, in as few system calls as possible.
+    The text goes straight to the file descriptor, bypassing the TextIOWrapper
+    encoder and buffer of sys.stdout, unless stdout has no file descriptor.
+    """
+    if sys.stdout is None:
+        return
+    sys.stdout.flush()  # Do not let text printed earlier come after this one
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, OSError, ValueError):
+        sys.stdout.write(text)
+        return
+    data = memoryview(text.encode('utf-8'))
+    while data:
+        data = data[os.write(fd, data):]
 
 def clear_terminal():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    write_stdout('\033[2J\033[H')
+
+# Set after a resize or any other output to the terminal, the screen is
+# cleared and the whole frame redrawn before the next frame
+_full_redraw = False
+# Terminal size, only queried again when the terminal is resized
+_term_size = shutil.get_terminal_size((80, 20))
+# Lines of the last frame written, only the lines that changed are rewritten.
+# None when the screen content is unknown (the frame did not fit).
+_prev_lines = []
+
+def _on_resize(signum, frame):
+    # Only flag the resize: writing to stdout from a signal handler could
+    # interrupt a frame being written
+    global _full_redraw, _term_size
+    _term_size = shutil.get_terminal_size((80, 20))
+    _full_redraw = True
+
+# Messages already printed by warn(), each one is only printed once
+_warned = set()
+
+def warn(message):
+    """
+    Prints a diagnostic message to stderr, once (the memtemp worker may hit
+    the same error on every read). As it may scroll or shift the display,
+    the whole frame is redrawn next time.
+    """
+    global _full_redraw
+    if message in _warned:
+        return
+    _warned.add(message)
+    print(message, file=sys.stderr)
+    _full_redraw = True
 
 def display_icon(value, threshold, icon="⚠️"):
     """Returns an icon if the value exceeds a threshold."""
     return icon if value >= threshold else "✅"
 
-# --- Fonctions de contrôle manuel des ventilateurs via nvidia-settings ---
-def set_fan_speed(gpu_index, speed):
+# --- Fonctions de contrôle manuel des ventilateurs ---
+# Minimum change (in %) of the target fan speed before the driver is updated again
+FAN_SPEED_HYSTERESIS = 2
+# Last value pushed to the driver for each GPU: a speed in %, or 'auto'
+_last_fan = {}
+# GPUs whose fans were ever set manually, they are all reverted on exit
+_fan_touched = set()
+
+def _nvidia_settings_set_fan_speed(gpu_index, speed):
     """
     Sets the fan speed (in %) for the specified GPU.
     Uses nvidia-settings to force manual control.
@@ -102,9 +185,9 @@ def set_fan_speed(gpu_index, speed):
         # On error, do nothing
         pass
 
-def revert_fan_control(gpu_index):
+def _nvidia_settings_revert_fan_control(gpu_index):
     """
-    Reverts the fan control to automatic for the specified GPU.
+    Reverts the fan control to automatic for the specified GPU using nvidia-settings.
     """
     try:
         subprocess.run(["nvidia-settings", "-a", f"[gpu:{gpu_index}]/GPUFanControlState=0"],
@@ -112,165 +195,563 @@ def revert_fan_control(gpu_index):
     except Exception as e:
         pass
 
+def set_fan_speed(device, speed):
+    """
+    Sets the fan speed (in %) of every fan of the specified GPU.
+    Uses NVML directly, and falls back to nvidia-settings when the
+    driver (or an older pynvml) does not support setting the fan speed through NVML.
+    """
+    if device['num_fans'] > 0:
+        try:
+            for fan_index in range(device['num_fans']):
+                nvmlDeviceSetFanSpeed_v2(device['handle'], fan_index, int(speed))
+            return
+        except (NVMLError, NameError):
+            pass
+    _nvidia_settings_set_fan_speed(device['id'], speed)
+
+def revert_fan_control(device):
+    """
+    Reverts the fan control to automatic for the specified GPU.
+    """
+    if device['num_fans'] > 0:
+        try:
+            for fan_index in range(device['num_fans']):
+                nvmlDeviceSetDefaultFanSpeed_v2(device['handle'], fan_index)
+            return
+        except (NVMLError, NameError):
+            pass
+    _nvidia_settings_revert_fan_control(device['id'])
+
+# Metrics that can be selected with --show
+SHOW_CHOICES = ('power', 'temp', 'util', 'clocks', 'mem', 'oc', 'fan')
+
+def parse_show(value):
+    show = {item.strip() for item in value.split(',') if item.strip()}
+    unknown = show - set(SHOW_CHOICES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown metric(s): {', '.join(sorted(unknown))} "
+                                         f"(choose from {', '.join(SHOW_CHOICES)})")
+    return show
+
+def _revert_all(devices):
+    """
+    Gives the fan control back to the driver on every GPU whose fans were
+    ever set manually, so they do not stay at a fixed speed once the tool exits.
+    """
+    for device in devices:
+        if device['id'] in _fan_touched:
+            revert_fan_control(device)
+            _last_fan[device['id']] = 'auto'
+
 def parse_args():
     nvmlInit()
     default_devices = list(range(nvmlDeviceGetCount()))
-    parser = argparse.ArgumentParser(description='Monitor Nvidia GPUs.')
-    parser.add_argument('--interval', type=int, default=1, help='Sampling interval in seconds (default: 1)')
+    parser = argparse.ArgumentParser(
+        description='Monitor Nvidia GPUs.',
+        epilog='The driver persistence mode is recommended, it avoids the driver being '
+               're-initialized between NVML queries. It is enabled at startup when run as root.')
+    parser.add_argument('--poll-interval', type=float, default=0.1,
+                        help='Interval in seconds between two GPU samples and fan control updates (default: 0.1)')
+    parser.add_argument('--display-interval', '--interval', dest='display_interval', type=float, default=1.0,
+                        help='Display refresh interval in seconds (default: 1)')
     parser.add_argument('--memtemp', action='store_true', help='Also display GDDR6 memory temperatures (requires root)')
+    parser.add_argument('--memtemp-interval', type=float, default=2.0,
+                        help='Interval in seconds between two GDDR6 temperature reads (default: 2)')
     # Nouveaux arguments pour les paramètres de contrôle des ventilateurs
     parser.add_argument('--fan-temp-threshold', type=float, default=60.0,
                         help='Temperature threshold to start increasing fan speed (°C) (default: 60)')
     parser.add_argument('--fan-temp-max', type=float, default=80.0,
                         help='Temperature at which fan is forced to 100%% (°C) (default: 80)')
+    parser.add_argument('--format', choices=['tui', 'json', 'prom'], default='tui',
+                        help='Output format: colored terminal display, one JSON line per refresh, '
+                             'or Prometheus text format (default: tui)')
+    parser.add_argument('--one-shot', action='store_true',
+                        help='Read and output the metrics once, then exit (the fans are not controlled)')
+    parser.add_argument('--show', type=parse_show, default=','.join(SHOW_CHOICES),
+                        help=f'Comma-separated list of the metrics to read and display, among '
+                             f'{",".join(SHOW_CHOICES)} (default: all)')
     args = parser.parse_args()
+    args.fan_lut = build_fan_lut(args.fan_temp_threshold, args.fan_temp_max)
     return args, default_devices
 
+def build_fan_lut(threshold, maximum):
+    """
+    Precomputes the fan curve for every integer temperature (°C).
+    Each entry is the fan speed (in %), or None below the threshold
+    where the fan control is left to the driver.
+    """
+    lut = []
+    temp_range = maximum - threshold
+    for temp in range(int(max(120, maximum)) + 1):
+        if temp < threshold:
+            lut.append(None)
+        elif temp_range <= 0:
+            lut.append(100)
+        else:
+            # Linear interpolation from threshold to maximum, with a floor
+            # division so the result does not depend on float rounding
+            lut.append(int(min(100, (temp - threshold) * 100 // temp_range)))
+    return lut
+
+def enable_persistence_mode(handle):
+    """
+    Enables the driver persistence mode of the GPU, so that NVML queries do not
+    pay for a driver re-initialization. Returns False if it could not be enabled.
+    """
+    try:
+        if nvmlDeviceGetPersistenceMode(handle) != NVML_FEATURE_ENABLED:
+            nvmlDeviceSetPersistenceMode(handle, NVML_FEATURE_ENABLED)
+    except NVMLError_NoPermission:
+        return False
+    except NVMLError:
+        # Not supported (e.g. on Windows, where the driver stays loaded anyway)
+        pass
+    return True
+
+def init_devices(default_devices):
+    """
+    Resolves the NVML handle and static attributes of each GPU once
+    (the power limit is not one of them, it can be changed at runtime),
+    so the main loop does not have to query them on every iteration.
+    """
+    devices = []
+    for device_id in default_devices:
+        handle = nvmlDeviceGetHandleByIndex(device_id)
+        try:
+            num_fans = nvmlDeviceGetNumFans(handle)
+        except (NVMLError, NameError):
+            # Older pynvml versions do not have it, nvidia-settings is used instead
+            num_fans = 0
+        total_mb = nvmlDeviceGetMemoryInfo(handle).total / (1024**2)
+        name = nvmlDeviceGetName(handle)
+        if isinstance(name, bytes):
+            # Older pynvml versions return bytes
+            name = name.decode()
+        devices.append({
+            'id': device_id,
+            'handle': handle,
+            'name': name,
+            'total_mb': total_mb,
+            'total_mb_str': f'{total_mb:.2f}',
+            'num_fans': num_fans,
+            # Cleared the first time NVML reports the application clock as not supported
+            'supports_app_core_clock': True,
+            'supports_app_mem_clock': True,
+        })
+    return devices
+
 def read_memtemp():
     if os.geteuid() == 0:
         try:
             return memtemp.get_mem_temps()
         except Exception as e:
-            print(f"Failed to get GDDR6 temperatures: {e}")            
+            warn(f"Failed to get GDDR6 temperatures: {e}")
     return []
 
-def main():
-    args, default_devices = parse_args()
-    total_lines = 0  # For refreshing the display
+# Latest GDDR6 temperatures, published by the memtemp worker thread.
+# The list is replaced as a whole, so readers never see a partial update.
+_mem_temps = {'v': []}
 
-    # If GDDR6 temperature display is requested, check for root privileges
-    if args.memtemp and os.geteuid() != 0:
-        print("Vous devez lancer en root pour afficher les températures GDDR6 et contrôler les ventilateurs.")
-        t.sleep(3)
+# Set on exit to stop the memtemp worker before the mappings are released
+_memtemp_stop = threading.Event()
 
-    # Initialize sdnotify if available
-    notifier = None
-    if SystemdNotifier is not None:
-        notifier = SystemdNotifier()
-        notifier.notify("READY=1")
+def _memtemp_worker(interval):
+    """Reads the GDDR6 temperatures in the background, off the sampling loop."""
+    while not _memtemp_stop.is_set():
+        _mem_temps['v'] = read_memtemp()
+        _memtemp_stop.wait(interval)
 
-    #clear_terminal()
-
-    while True:
-        mem_temps = read_memtemp()
-
-        # Clear the terminal
-        #if int(t.time()) % 10 == 0:
-        clear_terminal()
-
-        total_power = 0
-        total_vram_used = 0
-        total_utilization_gpu = 0
-
-        gpu_blocks = []  # List of information blocks for each GPU
+def _stop_memtemp(worker):
+    """
+    Stops the memtemp worker, then releases /dev/mem and the register mappings.
+    If the worker does not stop in time, the mappings are left to the OS.
+    """
+    _memtemp_stop.set()
+    worker.join(timeout=5)
+    if not worker.is_alive():
+        memtemp.cleanup()
 
-        for device_id in default_devices:
-            handle = nvmlDeviceGetHandleByIndex(device_id)
+def sample(args, devices, metrics=True, control=True):
+    """
+    Reads the metrics of every GPU and applies the manual fan control
+    (unless 'control' is False).
+    Only the metrics selected with --show are read, and none of them when
+    'metrics' is False (the fan control alone does not need them).
+    Returns the GDDR6 temperatures and a list of per-GPU metrics.
+    """
+    mem_temps = _mem_temps['v']
+    show = args.show if metrics else ()
+    stats = []
+
+    for device in devices:
+        device_id = device['id']
+        handle = device['handle']
+        power = max_tdp = gpu_temp = memory_info = utilization = None
+        gpu_clock = mem_clock = fan_speed_nvml = None
+        core_offset = core_lock = mem_offset = mem_lock = None
+
+        if 'power' in show:
             power = nvmlDeviceGetPowerUsage(handle) / 1000.0
+        if 'power' in show or 'oc' in show:
+            max_tdp = nvmlDeviceGetPowerManagementLimit(handle) / 1000.0
+        if 'temp' in show:
             gpu_temp = nvmlDeviceGetTemperature(handle, NVML_TEMPERATURE_GPU)
+        if 'mem' in show:
             memory_info = nvmlDeviceGetMemoryInfo(handle)
+        if 'util' in show:
             utilization = nvmlDeviceGetUtilizationRates(handle)
+        # The overclocking parameters are relative to the current clocks
+        if 'clocks' in show or 'oc' in show:
             gpu_clock = nvmlDeviceGetClockInfo(handle, NVML_CLOCK_GRAPHICS)
             mem_clock = nvmlDeviceGetClockInfo(handle, NVML_CLOCK_MEM)
-            max_tdp = nvmlDeviceGetPowerManagementLimit(handle) / 1000.0
-            gpu_name = nvmlDeviceGetName(handle)
+        if 'fan' in show:
             try:
                 # Retrieve the fan speed (in %)
                 fan_speed_nvml = nvmlDeviceGetFanSpeed(handle)
             except NVMLError_NotSupported:
                 fan_speed_nvml = 'Not Supported'
 
+        # Retrieve overclocking parameters
+        if 'oc' in show:
+            core_lock = gpu_clock
+            if device['supports_app_core_clock']:
+                try:
+                    core_lock = nvmlDeviceGetApplicationsClock(handle, NVML_CLOCK_GRAPHICS) or gpu_clock
+                except NVMLError_NotSupported:
+                    device['supports_app_core_clock'] = False
+                except NVMLError:
+                    pass
+            core_offset = core_lock - gpu_clock
+
+            mem_lock = mem_clock
+            if device['supports_app_mem_clock']:
+                try:
+                    mem_lock = nvmlDeviceGetApplicationsClock(handle, NVML_CLOCK_MEM) or mem_clock
+                except NVMLError_NotSupported:
+                    device['supports_app_mem_clock'] = False
+                except NVMLError:
+                    pass
+            mem_offset = mem_lock - mem_clock
+
+        # Manual fan control based on GDDR6 temperature
+        # (only if --memtemp is enabled and a temperature is available)
+        if control and args.memtemp and (device_id < len(mem_temps)) and (mem_temps[device_id] is not None):
+            gddr6_temp = min(max(int(mem_temps[device_id]), 0), len(args.fan_lut) - 1)
+            target = args.fan_lut[gddr6_temp]
+            if target is not None:
+                last = _last_fan.get(device_id)
+                # Always push 100% so the fans really reach full speed at fan_temp_max
+                if (last is None or last == 'auto' or abs(target - last) >= FAN_SPEED_HYSTERESIS
+                        or (target == 100 and last != 100)):
+                    # Recorded before pushing: if the tool is stopped while the fans are
+                    # being set, the exit handler must still revert them
+                    _fan_touched.add(device_id)
+                    _last_fan[device_id] = target
+                    set_fan_speed(device, target)
+                fan_control_info = f"Manual Fan Speed: {_last_fan[device_id]}%"
+            else:
+                if _last_fan.get(device_id) != 'auto':
+                    revert_fan_control(device)
+                    _last_fan[device_id] = 'auto'
+                fan_control_info = "Fan Control: Auto"
+        elif 'fan' in show:
+            fan_control_info = f"Fan Speed: {fan_speed_nvml}%"
+        else:
+            fan_control_info = None
+
+        stats.append({
+            'power': power,
+            'max_tdp': max_tdp,
+            'gpu_temp': gpu_temp,
+            'memory_info': memory_info,
+            'utilization': utilization,
+            'gpu_clock': gpu_clock,
+            'mem_clock': mem_clock,
+            'core_offset': core_offset,
+            'core_lock': core_lock,
+            'mem_offset': mem_offset,
+            'mem_lock': mem_lock,
+            'fan_speed': fan_speed_nvml,
+            'fan_control_info': fan_control_info,
+        })
+
+    return mem_temps, stats
+
+def render(args, devices, mem_temps, stats):
+    """
+    Displays the last sampled metrics.
+    """
+    # Clear the terminal after a resize or another output, the frame layout may
+    # have changed and the lines that did not change would not be rewritten
+    global _full_redraw, _prev_lines
+    if _full_redraw:
+        clear_terminal()
+        _full_redraw = False
+        _prev_lines = []
+
+    # Totals are accumulated in the same pass that builds the GPU blocks
+    total_power = 0
+    total_vram_used = 0
+    total_utilization_gpu = 0
+
+    gpu_blocks = []  # List of information blocks for each GPU
+
+    for device, stat in zip(devices, stats):
+        device_id = device['id']
+        gpu_name = device['name']
+        max_tdp_str = f'{stat["max_tdp"]:.2f}' if stat['max_tdp'] is not None else None
+        power = stat['power']
+        gpu_temp = stat['gpu_temp']
+        memory_info = stat['memory_info']
+        utilization = stat['utilization']
+
+        # Build the information block for the current GPU
+        block = []
+        block.append(cyan(f'GPU {device_id} ({gpu_name}) Status:', bold=True))
+        if 'power' in args.show:
             total_power += power
-            total_vram_used += memory_info.used
+            block.append(green(f'Power: {power:.2f} W / Max TDP: {max_tdp_str} W'))
+        if 'temp' in args.show:
+            block.append(yellow(f'Temp: {gpu_temp} °C {display_icon(gpu_temp, 80, "🔥")}'))
+        # Display GDDR6 temperature if enabled
+        if args.memtemp:
+            if device_id < len(mem_temps) and mem_temps[device_id] is not None:
+                block.append(yellow(f'GDDR6: {mem_temps[device_id]} °C {display_icon(mem_temps[device_id], 100, "🔥")}'))
+            else:
+                block.append(yellow('GDDR6 Temp: Not Available'))
+        if 'util' in args.show:
             total_utilization_gpu += utilization.gpu
+            block.append(green(f'Utilization - GPU: {utilization.gpu}%, Memory: {utilization.memory}%'))
+        if 'clocks' in args.show:
+            block.append(yellow(f'Clocks - GPU: {stat["gpu_clock"]} MHz, Memory: {stat["mem_clock"]} MHz'))
+        if 'mem' in args.show:
+            total_vram_used += memory_info.used
+            block.append(green(f'Memory - Total: {device["total_mb_str"]} MB, Used: {memory_info.used/(1024**2):.2f} MB'))
+        if stat['fan_control_info'] is not None:
+            block.append(green(stat['fan_control_info']))
+        if 'oc' in args.show:
+            block.append(green('OC Parameters:'))
+            block.append(green(f'  Core clock offset: {stat["core_offset"]} MHz'))
+            block.append(green(f'  Core clock lock: {stat["core_lock"]} MHz'))
+            block.append(green(f'  Memory clock offset: {stat["mem_offset"]} MHz'))
+            block.append(green(f'  Memory clock lock: {stat["mem_lock"]} MHz'))
+            block.append(green(f'  Powerlimit: {max_tdp_str} W'))
+
+        gpu_blocks.append(block)
+
+    # Prepare header and footer for display
+    header_lines = [
+        get_separator('=', 40),
+        blue('NVIDIA GPU Monitoring Tool', bold=True),
+        get_separator('=', 40)
+    ]
+    grid_lines = print_columns(gpu_blocks, padding=4)
+    footer_lines = []
+    if 'power' in args.show:
+        footer_lines.append(cyan(f'Total power consumption: {total_power:.2f} W', bold=True))
+    if 'mem' in args.show:
+        footer_lines.append(cyan(f'Total VRAM used: {total_vram_used/(1024**2):.2f} MB', bold=True))
+    if 'util' in args.show:
+        avg_utilization_gpu = total_utilization_gpu / args.n_devices if args.n_devices else 0
+        footer_lines.append(yellow(f'Total GPU utilization: {total_utilization_gpu:.2f}%', bold=True))
+        footer_lines.append(yellow(f'Average GPU utilization: {avg_utilization_gpu:.2f}%', bold=True))
+
+    all_lines = header_lines + grid_lines + footer_lines
+
+    new_lines = [str(line) for line in all_lines]
+    frame_width = max(visible_length(line) for line in all_lines)
+    if len(new_lines) >= _term_size.lines or frame_width > _term_size.columns:
+        # The frame does not fit: rows past the bottom or wrapped lines would break
+        # the line positions, so write it whole and let the terminal scroll
+        write_stdout("\033[H" + "\n".join(line + "\033[K" for line in new_lines) + "\033[J\n")
+        _prev_lines = None
+        return
+
+    # Only rewrite the lines that differ from the previous frame, all in one write
+    out = []
+    if _prev_lines is None:
+        # The previous frame scrolled the screen, start again from a blank one
+        out.append("\033[2J")
+        _prev_lines = []
+    for i, line in enumerate(new_lines):
+        if i >= len(_prev_lines) or line != _prev_lines[i]:
+            out.append(f"\033[{i+1};1H\033[2K{line}")
+    # Clear what remains of a longer previous frame, and leave the cursor below the frame
+    out.append(f"\033[{len(new_lines)+1};1H")
+    if len(new_lines) < len(_prev_lines):
+        out.append("\033[J")
+    write_stdout("".join(out))
+    _prev_lines = new_lines
+
+def collect(args, devices, mem_temps, stats):
+    """
+    Returns the last sampled metrics as plain values, for the machine-readable formats.
+    """
+    gpus = []
+    for device, stat in zip(devices, stats):
+        device_id = device['id']
+        gpu = {'id': device_id, 'name': device['name']}
+        if 'power' in args.show:
+            gpu['power_w'] = stat['power']
+            gpu['max_tdp_w'] = stat['max_tdp']
+        if 'temp' in args.show:
+            gpu['temp_c'] = stat['gpu_temp']
+        if args.memtemp:
+            gpu['gddr6_temp_c'] = mem_temps[device_id] if device_id < len(mem_temps) else None
+        if 'util' in args.show:
+            gpu['utilization_gpu'] = stat['utilization'].gpu
+            gpu['utilization_memory'] = stat['utilization'].memory
+        if 'clocks' in args.show:
+            gpu['clock_gpu_mhz'] = stat['gpu_clock']
+            gpu['clock_mem_mhz'] = stat['mem_clock']
+        if 'mem' in args.show:
+            gpu['memory_total_mb'] = device['total_mb']
+            gpu['memory_used_mb'] = stat['memory_info'].used / (1024**2)
+        if 'fan' in args.show:
+            gpu['fan_speed'] = stat['fan_speed'] if isinstance(stat['fan_speed'], int) else None
+        if args.memtemp:
+            # Speed (in %) set by the manual fan control, or 'auto'
+            gpu['fan_control'] = _last_fan.get(device_id)
+        if 'oc' in args.show:
+            gpu['core_clock_offset_mhz'] = stat['core_offset']
+            gpu['core_clock_lock_mhz'] = stat['core_lock']
+            gpu['mem_clock_offset_mhz'] = stat['mem_offset']
+            gpu['mem_clock_lock_mhz'] = stat['mem_lock']
+        gpus.append(gpu)
+    return {'timestamp': t.time(), 'gpus': gpus}
+
+# Prometheus metrics: (key in collect(), metric name, help)
+PROM_METRICS = [
+    ('power_w', 'autofan_gpu_power_watts', 'Power usage'),
+    ('max_tdp_w', 'autofan_gpu_power_limit_watts', 'Power management limit'),
+    ('temp_c', 'autofan_gpu_temperature_celsius', 'GPU temperature'),
+    ('gddr6_temp_c', 'autofan_gpu_memory_temperature_celsius', 'GDDR6 memory temperature'),
+    ('utilization_gpu', 'autofan_gpu_utilization_percent', 'GPU utilization'),
+    ('utilization_memory', 'autofan_gpu_memory_utilization_percent', 'Memory controller utilization'),
+    ('clock_gpu_mhz', 'autofan_gpu_clock_mhz', 'Graphics clock'),
+    ('clock_mem_mhz', 'autofan_gpu_memory_clock_mhz', 'Memory clock'),
+    ('memory_total_mb', 'autofan_gpu_memory_total_megabytes', 'Total memory'),
+    ('memory_used_mb', 'autofan_gpu_memory_used_megabytes', 'Used memory'),
+    ('fan_speed', 'autofan_gpu_fan_speed_percent', 'Fan speed reported by the driver'),
+    ('fan_control', 'autofan_gpu_fan_control_percent', 'Fan speed set by the manual fan control'),
+    ('core_clock_offset_mhz', 'autofan_gpu_core_clock_offset_mhz', 'Core clock offset'),
+    ('core_clock_lock_mhz', 'autofan_gpu_core_clock_lock_mhz', 'Core clock lock'),
+    ('mem_clock_offset_mhz', 'autofan_gpu_mem_clock_offset_mhz', 'Memory clock offset'),
+    ('mem_clock_lock_mhz', 'autofan_gpu_mem_clock_lock_mhz', 'Memory clock lock'),
+]
+
+def format_prom(data):
+    """Formats the collected metrics in the Prometheus text exposition format."""
+    lines = []
+    for key, name, help_text in PROM_METRICS:
+        samples = []
+        for gpu in data['gpus']:
+            value = gpu.get(key)
+            if isinstance(value, (int, float)):
+                gpu_name = gpu['name'].replace('\\', '\\\\').replace('"', '\\"')
+                samples.append(f'{name}{{gpu="{gpu["id"]}",name="{gpu_name}"}} {value}')
+        if samples:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+def emit(args, devices, mem_temps, stats):
+    """
+    Outputs the last sampled metrics in the machine-readable format
+    selected with --format, without any of the terminal rendering.
+    """
+    data = collect(args, devices, mem_temps, stats)
+    if args.format == 'json':
+        write_stdout(json.dumps(data) + '\n')
+    else:
+        write_stdout(format_prom(data))
 
-            # Retrieve overclocking parameters
-            try:
-                core_lock = nvmlDeviceGetApplicationsClock(handle, NVML_CLOCK_GRAPHICS)
-                if core_lock == 0:
-                    core_lock = gpu_clock
-            except NVMLError:
-                core_lock = gpu_clock
-            core_offset = core_lock - gpu_clock
+def main():
+    args, default_devices = parse_args()
+    devices = init_devices(default_devices)
+    # The GPU count does not change, it is not recomputed on each refresh
+    args.n_devices = len(devices)
+    startup_warning = False
 
-            try:
-                mem_lock = nvmlDeviceGetApplicationsClock(handle, NVML_CLOCK_MEM)
-                if mem_lock == 0:
-                    mem_lock = mem_clock
-            except NVMLError:
-                mem_lock = mem_clock
-            mem_offset = mem_lock - mem_clock
+    # Enabling the persistence mode requires root, and a one-shot read is only
+    # a scrape, it leaves the driver state alone
+    if not args.one_shot and os.geteuid() == 0:
+        if not all([enable_persistence_mode(device['handle']) for device in devices]):
+            warn("Could not enable the persistence mode, NVML queries may be slower.")
+
+    # If GDDR6 temperature display is requested, check for root privileges
+    if args.memtemp and os.geteuid() != 0:
+        warn("Vous devez lancer en root pour afficher les températures GDDR6 et contrôler les ventilateurs.")
+        startup_warning = True
+
+    # Leave the warnings on screen for a moment before the display takes over the terminal
+    if startup_warning and args.format == 'tui' and not args.one_shot:
+        t.sleep(3)
+
+    output = render if args.format == 'tui' else emit
+    if args.format == 'tui':
+        clear_terminal()
+
+    if args.one_shot:
+        if args.memtemp:
+            _mem_temps['v'] = read_memtemp()
+            memtemp.cleanup()
+        mem_temps, stats = sample(args, devices, control=False)
+        output(args, devices, mem_temps, stats)
+        return
+
+    # Revert the fans to automatic control on exit, including on Ctrl+C, when
+    # systemd stops the service (SIGTERM) and when the terminal or SSH session
+    # is closed (SIGHUP)
+    atexit.register(_revert_all, devices)
+    for sig in (signal.SIGTERM, getattr(signal, 'SIGHUP', None), getattr(signal, 'SIGQUIT', None)):
+        if sig is not None:
+            signal.signal(sig, lambda *_: sys.exit(0))
+
+    # Initialize sdnotify if available
+    notifier = None
+    if SystemdNotifier is not None:
+        notifier = SystemdNotifier()
+        notifier.notify("READY=1")
+
+    if args.memtemp:
+        worker = threading.Thread(target=_memtemp_worker, args=(args.memtemp_interval,), daemon=True)
+        worker.start()
+        atexit.register(_stop_memtemp, worker)
+
+    if args.format == 'tui' and hasattr(signal, 'SIGWINCH'):
+        signal.signal(signal.SIGWINCH, _on_resize)
 
-            # Manual fan control based on GDDR6 temperature
-            # (only if --memtemp is enabled and a temperature is available)
-            if args.memtemp and (device_id < len(mem_temps)) and (mem_temps[device_id] is not None):
-                gddr6_temp = mem_temps[device_id]
-                if gddr6_temp >= args.fan_temp_threshold:
-                    # Linear interpolation: from fan_temp_threshold to fan_temp_max
-                    new_fan_speed = ((gddr6_temp - args.fan_temp_threshold) /
-                                     (args.fan_temp_max - args.fan_temp_threshold)) * 100
-                    new_fan_speed = min(100, new_fan_speed)
-                    set_fan_speed(device_id, new_fan_speed)
-                    fan_control_info = get_color_text('green', f"Manual Fan Speed: {int(new_fan_speed)}%")
-                else:
-                    revert_fan_control(device_id)
-                    fan_control_info = get_color_text('green', "Fan Control: Auto")
+    # Notify the watchdog once per display refresh, but at least twice per
+    # watchdog timeout when systemd sets one
+    watchdog_interval = args.display_interval
+    if os.environ.get('WATCHDOG_USEC', '').isdigit():
+        watchdog_interval = min(watchdog_interval, int(os.environ['WATCHDOG_USEC']) / 2e6)
+
+    last_render = None
+    last_watchdog = None
+    try:
+        while True:
+            # Fan control runs on every sample, the metrics are only read and
+            # displayed every display_interval
+            now = t.monotonic()
+            if last_render is None or now - last_render >= args.display_interval:
+                mem_temps, stats = sample(args, devices)
+                output(args, devices, mem_temps, stats)
+                last_render = now
             else:
-                fan_control_info = get_color_text('green', f"Fan Speed: {fan_speed_nvml}%")
-
-            # Build the information block for the current GPU
-            block = []
-            block.append(get_color_text('cyan', f'GPU {device_id} ({gpu_name}) Status:', bold=True))
-            block.append(get_color_text('green', f'Power: {power:.2f} W / Max TDP: {max_tdp:.2f} W'))
-            block.append(get_color_text('yellow', f'Temp: {gpu_temp} °C {display_icon(gpu_temp, 80, "🔥")}'))
-            # Display GDDR6 temperature if enabled
-            if args.memtemp:
-                if device_id < len(mem_temps) and mem_temps[device_id] is not None:
-                    block.append(get_color_text('yellow', f'GDDR6: {mem_temps[device_id]} °C {display_icon(mem_temps[device_id], 100, "🔥")}'))
-                else:
-                    block.append(get_color_text('yellow', 'GDDR6 Temp: Not Available'))
-            block.append(get_color_text('green', f'Utilization - GPU: {utilization.gpu}%, Memory: {utilization.memory}%'))
-            block.append(get_color_text('yellow', f'Clocks - GPU: {gpu_clock} MHz, Memory: {mem_clock} MHz'))
-            block.append(get_color_text('green', f'Memory - Total: {memory_info.total/(1024**2):.2f} MB, Used: {memory_info.used/(1024**2):.2f} MB'))
-            block.append(fan_control_info)
-            block.append(get_color_text('green', 'OC Parameters:'))
-            block.append(get_color_text('green', f'  Core clock offset: {core_offset} MHz'))
-            block.append(get_color_text('green', f'  Core clock lock: {core_lock} MHz'))
-            block.append(get_color_text('green', f'  Memory clock offset: {mem_offset} MHz'))
-            block.append(get_color_text('green', f'  Memory clock lock: {mem_lock} MHz'))
-            block.append(get_color_text('green', f'  Powerlimit: {max_tdp:.2f} W'))
-
-            gpu_blocks.append(block)
-
-        # Prepare header and footer for display
-        header_lines = [
-            get_separator('=', 40),
-            get_color_text('blue', 'NVIDIA GPU Monitoring Tool', bold=True),
-            get_separator('=', 40)
-        ]
-        grid_lines = print_columns(gpu_blocks, padding=4)
-        avg_utilization_gpu = total_utilization_gpu / len(default_devices)
-        footer_lines = [
-            get_color_text('cyan', f'Total power consumption: {total_power:.2f} W', bold=True),
-            get_color_text('cyan', f'Total VRAM used: {total_vram_used/(1024**2):.2f} MB', bold=True),
-            get_color_text('yellow', f'Total GPU utilization: {total_utilization_gpu:.2f}%', bold=True),
-            get_color_text('yellow', f'Average GPU utilization: {avg_utilization_gpu:.2f}%', bold=True)
-        ]
-        
-        all_lines = header_lines + grid_lines + footer_lines
-
-        # Clear the previous output by moving the cursor up
-        if total_lines > 0:
-            move_cursor_up(total_lines)
-        for line in all_lines:
-            print(line)
-        total_lines = len(all_lines)
-        
-        # Send the WATCHDOG notification if sdnotify is available
-        if notifier:
-            notifier.notify("WATCHDOG=1")
-            
-        t.sleep(args.interval)
+                sample(args, devices, metrics=False)
+
+            # Send the WATCHDOG notification if sdnotify is available
+            if notifier and (last_watchdog is None or now - last_watchdog >= watchdog_interval):
+                notifier.notify("WATCHDOG=1")
+                last_watchdog = now
+
+            t.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     main()
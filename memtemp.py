@@ -62,6 +62,9 @@ class GDDR6Context:
         self.devices = []
         self.fd = -1
         self.page_size = os.sysconf("SC_PAGE_SIZE")
+        # True once the devices are detected and mapped, they are kept
+        # mapped so that the following reads do not repeat it
+        self.mapped = False
 
 ctx = GDDR6Context()
 
@@ -76,8 +79,11 @@ def cleanup():
     for d in ctx.devices:
         if d.mapped_addr is not None:
             d.mapped_addr.close()
+            d.mapped_addr = None
     if ctx.fd != -1:
         os.close(ctx.fd)
+        ctx.fd = -1
+    ctx.mapped = False
 
 def detect_compatible_gpus():
     try:
@@ -144,29 +150,38 @@ def memory_map():
         except OSError:
             d.mapped_addr = None
 
-def get_mem_temps():
-    # returns list of GDDR6 temps for detected devices
+def setup():
+    # opens /dev/mem, detects and maps the devices, once
+    if ctx.mapped:
+        return True
     if not init():
         # cannot open /dev/mem
-        return []
-    n = detect_compatible_gpus()
-    if n == 0:
+        return False
+    try:
+        if detect_compatible_gpus() > 0:
+            memory_map()
+    except Exception:
+        # e.g. lspci missing, do not leak the /dev/mem fd
         cleanup()
+        raise
+    # the mappings stay open between reads, the caller releases them
+    # with cleanup() once it is done reading
+    ctx.mapped = True
+    return True
+
+def get_mem_temps():
+    # returns list of GDDR6 temps for detected devices
+    if not setup():
         return []
-    memory_map()
 
     temps = []
     for d in ctx.devices:
         if d.mapped_addr is not None:
-            addr_offset = d.phys_addr - d.base_offset
-            d.mapped_addr.seek(addr_offset)
-            data = d.mapped_addr.read(4)
-            read_result = struct.unpack("<I", data)[0]
+            read_result = struct.unpack_from("<I", d.mapped_addr, d.phys_addr - d.base_offset)[0]
             temp = (read_result & 0x00000FFF) // 0x20
             temps.append(temp)
         else:
             temps.append(None)
-    cleanup()
     return temps
 
 if __name__ == "__main__":
@@ -175,6 +190,7 @@ if __name__ == "__main__":
         print("Run as root to see GDDR6 temps.")
         sys.exit(1)
     temps = get_mem_temps()
+    cleanup()
     if temps:
         print("VRAM Temps:", temps)
     else: